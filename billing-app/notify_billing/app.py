@@ -1,40 +1,141 @@
 import os
-import math
+import time
 import boto3
+from botocore.config import Config
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
-import yfinance as yf 
-from datetime import datetime, timedelta, timezone
-from pandas_datareader import data as pdr
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
+from typing import Any
 
 logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(asctime)s %(message)s")
 logger = logging.getLogger()
-ce_client = boto3.client('ce', region_name='ap-northeast-1')
+ce_client = boto3.client(
+    'ce',
+    region_name='ap-northeast-1',
+    config=Config(
+        max_pool_connections=50,
+        retries={'max_attempts': 3, 'mode': 'adaptive'}
+    )
+)
+# HTTP接続をウォームスタート間で再利用するためのセッション
+_HTTP = requests.Session()
+_HTTP.mount('https://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=4,
+    max_retries=Retry(total=2, backoff_factor=0.2)
+))
+DEFAULT_EXCHANGE_RATE_API_URL = 'https://open.er-api.com/v6/latest/USD'
+# Discord通知本文のテンプレート (呼び出しごとに内容を差し替えて使用する)
+_DISCORD_BODY = {
+    "content": "@everyone\n",
+    "embeds": [{
+        "title": "",
+        "description": ""
+    }]
+}
+_DISCORD_FOOTER = {
+    "text": ""
+}
 JST = timezone(timedelta(hours=+9), 'JST')
-dt_now = datetime.now(JST)
+# 料金取得結果のキャッシュ (ウォームスタート時に再利用)
+_CE_CACHE: dict[tuple[str, str, str], tuple[float, Any]] = {}
 
-def get_exchange_rate() -> int:
+def ttl_cache(seconds: int):
+    """
+    料金取得結果を対象期間ごとに一定時間キャッシュするデコレータ
+
+    Parameters
+    ----------
+    seconds : int
+        キャッシュ有効期間(秒)
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(client, today: date):
+            key = (func.__name__, *get_total_cost_date_range(today))
+            cached = _CE_CACHE.get(key)
+            if cached is not None and time.monotonic() - cached[0] < seconds:
+                return cached[1]
+
+            result = func(client, today)
+            # 取得失敗時はキャッシュしない
+            if result is not None:
+                _CE_CACHE[key] = (time.monotonic(), result)
+            return result
+        return wrapper
+    return decorator
+
+def to_cents(amount: Decimal) -> int:
+    """
+    USD金額をセント単位の整数に変換
+
+    Parameters
+    ----------
+    amount : Decimal
+        USD金額
+
+    Returns
+    -------
+    cents : int
+        USDセント (セント未満は偶数丸め)
+    """
+    return int((amount * 100).to_integral_value())
+
+def format_usd(cents: int) -> str:
+    """
+    セント単位の整数をUSD表記(小数点以下2桁)に整形
+
+    Parameters
+    ----------
+    cents : int
+        USDセント
+
+    Returns
+    -------
+    usd : str
+        USD表記
+    """
+    sign = '-' if cents < 0 else ''
+    (dollars, cents) = divmod(abs(cents), 100)
+    return f'{sign}{dollars}.{cents:02d}'
+
+def _now() -> datetime:
+    """
+    現在日時(JST)を取得
+    ウォームスタート時に日付が古くならないよう、呼び出しごとに取得する
+
+    Returns
+    -------
+    now : datetime
+        現在日時(JST)
+    """
+    return datetime.now(JST)
+
+def get_exchange_rate() -> Decimal:
     """
     ドル円為替レート取得
+    取得先(EXCHANGE_RATE_API_URL)はUSD基準で {"rates": {"JPY": <レート>}} 形式の
+    JSONを返すこと
 
     Returns
     -------
-    exchange_rate : int
-        ドル円為替レート
+    exchange_rate : Decimal
+        ドル円為替レート (取得失敗時は0)
     """
     try:
-        date_range = {
-            "start": (dt_now + timedelta(days=-1)).strftime('%Y-%m-%d'),
-            "end": dt_now.strftime('%Y-%m-%d')
-        }
-        ticker = "JPY=X"
-        yf.pdr_override()
-        df = pdr.get_data_yahoo(ticker, date_range["start"], date_range["end"])
-        exchange_rate = math.ceil(df.iloc[0][3])
-        return exchange_rate
+        url = os.getenv('EXCHANGE_RATE_API_URL', DEFAULT_EXCHANGE_RATE_API_URL)
+        response = _HTTP.get(url, timeout=3)
+        response.raise_for_status()
+        rates = response.json(parse_float=Decimal)['rates']
+        return Decimal(rates['JPY'])
     except Exception as e:
         logger.error(f"為替レートの取得に失敗しました。エラー: {str(e)}")
-        return 0
+        return Decimal(0)
 
 def post_discord(title:str, msg: str, footer: str) -> None:
     """
@@ -49,38 +150,33 @@ def post_discord(title:str, msg: str, footer: str) -> None:
         logger.error("DISCORD_WEBHOOK_URLが設定されていません。")
         return
     
+    # 送信内容はテンプレートを書き換えて使用する
+    body = _DISCORD_BODY
+    embed = body["embeds"][0]
+    embed["title"] = title
+    embed["description"] = msg
     if footer:
-        body = {
-            "content": f"@everyone\n",
-            "embeds": [{
-                "title": title,
-                "description": msg,
-                "footer": {
-                    "text": footer
-                }
-            }]
-        }
+        _DISCORD_FOOTER["text"] = footer
+        embed["footer"] = _DISCORD_FOOTER
     else:
-        body = {
-            "content": f"@everyone\n",
-            "embeds": [{
-                "title": f"{title}",
-                "description": f"{msg}"
-            }]
-        }
+        embed.pop("footer", None)
 
+    # Lambdaは処理終了後に実行環境が凍結されるため、送信完了まで待機する
     try:
-        requests.post(url, json=body)
+        _HTTP.post(url, json=body, timeout=3)
     except Exception as e:
         logger.exception(f"Discordへの通知に失敗しました。エラー: {str(e)}")
     
-def get_total_billing(client):
+@ttl_cache(seconds=3600)
+def get_service_billings(client, today: date):
     """
-    AWS使用料金の総額取得
+    AWS使用料金の総額・サービス別内訳取得
 
     Parameters
     ----------
     client : 
+    today : date
+        実行日付
 
     Retruns
     ----------
@@ -88,73 +184,66 @@ def get_total_billing(client):
         総額情報
         start: 対象期間期初
         end: 対象期間期末
-        billing: 総額
-    """
-    try:
-        (start_date, end_date) = get_total_cost_date_range()
-        response = client.get_cost_and_usage(
-            TimePeriod={
-                'Start': start_date,
-                'End': end_date
-            },
-            Granularity='MONTHLY',
-            Metrics=[
-                'AmortizedCost'
-            ]
-        )
-        return {
-            'start': response['ResultsByTime'][0]['TimePeriod']['Start'],
-            'end': response['ResultsByTime'][0]['TimePeriod']['End'],
-            'billing': response['ResultsByTime'][0]['Total']['AmortizedCost']['Amount'],
-        }
-    except Exception as e:
-        logger.exception(f"資料料金の取得に失敗しました。。エラー: {str(e)}")
-
-def get_service_billings(client):
-    """
-    AWS使用料金の総額取得
-
-    Parameters
-    ----------
-    client : 
-
-    Retruns
-    ----------
+        billing: 総額 (USDセント)
     billings : list[dict]
         各サービス料金内訳
         service_name: サービス名
-        billing: サービス料金
+        billing: サービス料金 (USDセント)
     """
     try:
-        (start_date, end_date) = get_total_cost_date_range()
+        (start_date, end_date) = get_total_cost_date_range(today)
 
-        response = client.get_cost_and_usage(
-            TimePeriod={
+        request = {
+            'TimePeriod': {
                 'Start': start_date,
                 'End': end_date
             },
-            Granularity='MONTHLY',
-            Metrics=[
+            'Granularity': 'MONTHLY',
+            'Metrics': [
                 'AmortizedCost'
             ],
-            GroupBy=[
+            'GroupBy': [
                 {
                     'Type': 'DIMENSION',
                     'Key': 'SERVICE'
                 }
             ]
-        )
+        }
         billings = []
-        for item in response['ResultsByTime'][0]['Groups']:
-            billings.append({
-                'service_name': item['Keys'][0],
-                'billing': item['Metrics']['AmortizedCost']['Amount']
-            })
-        return billings
+        total = Decimal(0)
+        # サービス数が多い場合は結果が分割されるため、NextPageTokenを辿って全件取得する
+        while True:
+            response = client.get_cost_and_usage(**request)
+            result = response['ResultsByTime'][0]
+            for item in result['Groups']:
+                amount = item['Metrics']['AmortizedCost']['Amount']
+                # 料金が発生していないサービスはDecimal変換前に除外する
+                if not float(amount):
+                    continue
+                amount = Decimal(amount)
+                total += amount
+                billings.append({
+                    'service_name': item['Keys'][0],
+                    'billing': to_cents(amount)
+                })
+
+            next_page_token = response.get('NextPageToken')
+            if not next_page_token:
+                break
+            request['NextPageToken'] = next_page_token
+
+        # 総額はサービス別料金の合計から算出する
+        period = result['TimePeriod']
+        total_billing = {
+            'start': period['Start'],
+            'end': period['End'],
+            'billing': to_cents(total),
+        }
+        return total_billing, billings
     except Exception as e:
         logger.exception(f"資料料金の取得に失敗しました。。エラー: {str(e)}")
 
-def get_message(total_billing: dict, service_billings: list) -> (str, str):
+def get_message(total_billing: dict, service_billings: list, exchange_rate: Decimal) -> (str, str, str):
     """
     Discordへ送信するメッセージの内容を作成
     
@@ -164,11 +253,13 @@ def get_message(total_billing: dict, service_billings: list) -> (str, str):
         総額情報
         start: 対象期間期初
         end: 対象期間期末
-        billing: 総額
+        billing: 総額 (USDセント)
     service_billings : list[dict]
         各サービス料金内訳
         service_name: サービス名
-        billing: サービス料金
+        billing: サービス料金 (USDセント)
+    exchange_rate : Decimal
+        ドル円為替レート (取得失敗時は0)
     
     Returns
     -------
@@ -179,48 +270,62 @@ def get_message(total_billing: dict, service_billings: list) -> (str, str):
     footer : str
         フッターメッセージ
     """
-    start = datetime.strptime(total_billing['start'], '%Y-%m-%d').strftime('%m/%d')
+    start_date = date.fromisoformat(total_billing['start'])
+    start = f'{start_date.month:02d}/{start_date.day:02d}'
+
+    end_today = date.fromisoformat(total_billing['end'])
+    end_yesterday = f'{end_today.month:02d}/{end_today.day:02d}'
 
-    end_today = datetime.strptime(total_billing['end'], '%Y-%m-%d')
-    end_yesterday = end_today.strftime('%m/%d')
+    # ループ内で不変な値は事前に用意しておく
+    # (為替レートは分子・分母の整数として扱い、ループ内の計算を整数演算のみにする)
+    has_exchange_rate = exchange_rate > 0
+    (rate_numerator, rate_denominator) = exchange_rate.as_integer_ratio()
+    yen_denominator = rate_denominator * 100
 
-    total = round(float(total_billing['billing']), 2)
-    exchange_rate = get_exchange_rate()
+    def to_yen(cents: int) -> int:
+        # 円未満は切り上げ
+        return -(-cents * rate_numerator // yen_denominator)
+
+    total = total_billing['billing']
 
     # タイトル
-    if exchange_rate > 0:
-        total_yen = math.ceil(total * exchange_rate)
-        title = f'{start}～{end_yesterday}の請求額は、￥{total_yen} ({total:.2f} USD)です。'
+    if has_exchange_rate:
+        title = f'{start}～{end_yesterday}の請求額は、￥{to_yen(total)} ({format_usd(total)} USD)です。'
     else:
-        title = f'{start}～{end_yesterday}の請求額は、{total:.2f} USDです。'
+        title = f'{start}～{end_yesterday}の請求額は、{format_usd(total)} USDです。'
 
     # メッセージボディ
-    details = []
-    for item in service_billings:
-        service_name = item['service_name']
-        billing = round(float(item['billing']), 2)
+    def format_detail_with_yen(service_name: str, billing: int) -> str:
+        return f'・{service_name}: ￥{to_yen(billing)} ({format_usd(billing)} USD)'
 
-        if billing == 0.0:
-            continue
+    def format_detail_usd_only(service_name: str, billing: int) -> str:
+        return f'・{service_name}: {format_usd(billing)} USD'
 
-        if exchange_rate > 0:
-            billing_yen = math.ceil(billing * exchange_rate)
-            details.append(f'・{service_name}: ￥{billing_yen} ({billing:.2f} USD)')
-        else:
-            details.append(f'・{service_name}: {billing:.2f} USD')
+    # 為替レートの有無はループ内で不変のため、使用する整形処理をループ前に決定する
+    format_detail = format_detail_with_yen if has_exchange_rate else format_detail_usd_only
+    details = '\n'.join(
+        format_detail(item['service_name'], item['billing']) for item in service_billings if item['billing']
+    )
 
     # フッターメッセージ
-    if exchange_rate > 0:
+    footer = ''
+    if has_exchange_rate:
         footer = f"※為替レート: {exchange_rate} 円/1ドル ({end_yesterday} 時点)"
 
 
-    return title, '\n'.join(details), footer
+    return title, details, footer
 
-def get_total_cost_date_range() -> (str, str):
+@functools.lru_cache(maxsize=1)
+def get_total_cost_date_range(today: date) -> (str, str):
     """
     awsから取得する使用料金の期間を返却する
     期間はAPI実行日付の1月前
     
+    Parameters
+    ----------
+    today : date
+        実行日付
+
     Returns
     -------
     start_date : str
@@ -229,43 +334,65 @@ def get_total_cost_date_range() -> (str, str):
         期末
     """
     start_date = 0
-    end_date = (dt_now + timedelta(days=-1)).strftime('%Y-%m-%d')
-    if dt_now.day == 1:
-        start_date = get_last_month_first_day()
+    end_date = (today + timedelta(days=-1)).strftime('%Y-%m-%d')
+    if today.day == 1:
+        start_date = get_last_month_first_day(today)
     else:
-        start_date = get_this_month_first_day()
+        start_date = get_this_month_first_day(today)
     
     return start_date, end_date
 
-def get_last_month_first_day() -> str:
+def get_last_month_first_day(today: date) -> str:
     """
     システム日付一月前月初日付を取得
     
+    Parameters
+    ----------
+    today : date
+        実行日付
+
     Returns
     -------
     last_month_first_day : str
         システム日付一月前月初日付
     """
-    last_month = dt_now.month - 1
-    last_month_year = dt_now.year
-    if last_month == 0:
-        last_month = 12
-        last_month_year -= 1
-    return dt_now.replace(year=last_month_year ,month=last_month, day=1).strftime('%Y-%m-%d')
-
-def get_this_month_first_day() -> str:
+    this_month_first_day = today.replace(day=1)
+    last_month_first_day = (this_month_first_day - timedelta(days=1)).replace(day=1)
+    return last_month_first_day.strftime('%Y-%m-%d')
+
+def get_this_month_first_day(today: date) -> str:
     """
     
+    Parameters
+    ----------
+    today : date
+        実行日付
+
     Returns
     -------
     this_month_first_day : str
         システム日付月初日付
     """
-    return dt_now.replace(day=1).strftime('%Y-%m-%d')
+    return today.replace(day=1).strftime('%Y-%m-%d')
 
 
 def lambda_handler(event, context) -> None:
-    total_billing = get_total_billing(ce_client)
-    service_billings = get_service_billings(ce_client)
-    (title, detail, footer) = get_message(total_billing, service_billings)
+    today = _now().date()
+
+    # 料金取得と為替レート取得は互いに独立しているため並列に実行する
+    # (I/O待ちは2件のみのため、aioboto3/aiohttpによる非同期化は依存追加による
+    #  パッケージサイズ・コールドスタート増に見合わずスレッドで並列化している)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        future_billings = executor.submit(get_service_billings, ce_client, today)
+        future_exchange_rate = executor.submit(get_exchange_rate)
+        billings = future_billings.result()
+        exchange_rate = future_exchange_rate.result()
+
+    # 料金取得に失敗した場合は通知しない
+    if billings is None:
+        logger.error("使用料金を取得できなかったため、通知を中止します。")
+        return
+    (total_billing, service_billings) = billings
+
+    (title, detail, footer) = get_message(total_billing, service_billings, exchange_rate)
     post_discord(title, detail, footer)